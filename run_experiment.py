@@ -33,6 +33,12 @@ if __name__ == "__main__":
                     help='Desired coverage is 1-alpha')
     parser.add_argument('--save_folder', type=str, default='.cache/paper/varying_n',
                         help='Folder to save results to')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Rerun methods that already have saved results')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of seeds to run in parallel. -1 uses all cores')
+    parser.add_argument('--use_float32', action='store_true',
+                        help='Cast softmax scores to float32 to reduce memory usage')
 
     
     args = parser.parse_args()
@@ -40,8 +46,12 @@ if __name__ == "__main__":
         run_one_experiment(args.dataset, args.save_folder, args.alpha, 
                            args.avg_num_per_class, args.score_functions, args.methods, args.seeds, 
                            cluster_args={'frac_clustering': args.frac_clustering, 'num_clusters': args.num_clusters}, 
-                           save_preds=False, calibration_sampling=args.calibration_sampling)
+                           save_preds=False, calibration_sampling=args.calibration_sampling,
+                           overwrite=args.overwrite, n_jobs=args.n_jobs,
+                           use_float32=args.use_float32)
     else: # choose frac_clustering and num_clusters automatically 
         run_one_experiment(args.dataset, args.save_folder, args.alpha, 
                            args.avg_num_per_class, args.score_functions, args.methods, args.seeds, 
-                           save_preds=False, calibration_sampling=args.calibration_sampling)
\ No newline at end of file
+                           save_preds=False, calibration_sampling=args.calibration_sampling,
+                           overwrite=args.overwrite, n_jobs=args.n_jobs,
+                           use_float32=args.use_float32)
\ No newline at end of file
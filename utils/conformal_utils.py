@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import warnings
 
 import pdb
 
@@ -98,29 +99,25 @@ def split_X_and_y(X, y, n_k, num_classes, seed=0, split='balanced'):
         raise Exception('Valid split options are "balanced" or "proportional"')
             
     
-    if len(X.shape) == 2:
-        X1 = np.zeros((np.sum(n_k), X.shape[1]))
-    else:
-        X1 = np.zeros((np.sum(n_k),))
-    y1 = np.zeros((np.sum(n_k), ), dtype=np.int32)
+    # Group indices by class once instead of scanning y for every class 
+    # (indices within each class remain in increasing order)
+    sorted_idx, starts, ends = group_scores_by_label(np.arange(len(y)), y, num_classes)
     
-    all_selected_indices = np.zeros(y.shape)
-
-    i = 0
+    all_selected_idx = []
     for k in range(num_classes):
 
         # Randomly select n instances of class k
-        idx = np.argwhere(y==k).flatten()
-        selected_idx = np.random.choice(idx, replace=False, size=(n_k[k],))
-
-        X1[i:i+n_k[k]] = X[selected_idx]
-        y1[i:i+n_k[k]] = k
-        i += n_k[k]
+        idx = sorted_idx[starts[k]:ends[k]]
+        all_selected_idx.append(np.random.choice(idx, replace=False, size=(n_k[k],)))
         
-        all_selected_indices[selected_idx] = 1
+    all_selected_idx = np.concatenate(all_selected_idx)
+    X1 = X[all_selected_idx]
+    y1 = np.repeat(np.arange(num_classes, dtype=np.int32), n_k)
         
-    X2 = X[all_selected_indices == 0]
-    y2 = y[all_selected_indices == 0]
+    is_selected = np.zeros(y.shape, dtype=bool)
+    is_selected[all_selected_idx] = True
+    X2 = X[~is_selected]
+    y2 = y[~is_selected]
     
     return X1, y1, X2, y2
 
@@ -178,6 +175,28 @@ def get_conformal_quantile(scores, alpha, default_qhat=np.inf, exact_coverage=Fa
 
         return qhat
 
+def group_scores_by_label(scores, labels, num_classes):
+    '''
+    Sort scores by label once so that the scores for each class form a contiguous block,
+    which avoids scanning all of labels for every class
+    
+    Inputs:
+        - scores: num_instances-length array of conformal scores for true class
+        - labels: num_instances-length array of class labels. Labels outside of 
+        0,...,num_classes-1 (e.g., -1) are ignored
+        - num_classes: number of classes
+        
+    Output: sorted_scores, starts, ends such that sorted_scores[starts[k]:ends[k]] contains
+    the scores of all instances with label k
+    '''
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    sorted_scores = scores[order]
+    starts = np.searchsorted(sorted_labels, np.arange(num_classes), side='left')
+    ends = np.searchsorted(sorted_labels, np.arange(num_classes), side='right')
+    
+    return sorted_scores, starts, ends
+
 #========================================
 #   Standard conformal prediction
 #========================================
@@ -351,15 +370,13 @@ def compute_class_specific_qhats(cal_scores_all, cal_true_labels, num_classes, a
 
 
         q_hats = np.zeros((num_classes,)) # q_hats[i] = quantile for class i
-        class_cts = np.zeros((num_classes,))
+        sorted_scores, starts, ends = group_scores_by_label(cal_scores_all, cal_true_labels, num_classes)
+        class_cts = ends - starts
 
         for k in range(num_classes):
 
             # Only select data for which k is true class
-            idx = (cal_true_labels == k)
-            scores = cal_scores_all[idx]
-
-            class_cts[k] = scores.shape[0]
+            scores = sorted_scores[starts[k]:ends[k]]
 
             q_hats[k] = get_conformal_quantile(scores, alpha, default_qhat=default_qhat)
             
@@ -482,7 +499,7 @@ def compute_cluster_specific_qhats(cluster_assignments, cal_scores_all, cal_true
             return null_qhat * np.ones(cluster_assignments.shape)
     
     # Map true class labels to clusters
-    cal_true_clusters = np.array([cluster_assignments[label] for label in cal_true_labels])
+    cal_true_clusters = cluster_assignments[cal_true_labels]
     
     # Compute cluster qhats
     if exact_coverage:
@@ -494,10 +511,9 @@ def compute_cluster_specific_qhats(cluster_assignments, cal_scores_all, cal_true
                                                                           alpha=alpha, 
                                                                           default_qhat=np.inf, null_params=null_params)
         # Map cluster qhats back to classes
-        num_classes = len(cluster_assignments)
-        q_as = np.array([clustq_as[cluster_assignments[k]] for k in range(num_classes)])
-        q_bs = np.array([clustq_bs[cluster_assignments[k]] for k in range(num_classes)])
-        gammas = np.array([clustgammas[cluster_assignments[k]] for k in range(num_classes)])
+        q_as = clustq_as[cluster_assignments]
+        q_bs = clustq_bs[cluster_assignments]
+        gammas = clustgammas[cluster_assignments]
 
         return q_as, q_bs, gammas
    
@@ -508,8 +524,7 @@ def compute_cluster_specific_qhats(cluster_assignments, cal_scores_all, cal_true
                                                      default_qhat=np.inf,
                                                      null_qhat=null_qhat)                            
         # Map cluster qhats back to classes
-        num_classes = len(cluster_assignments)
-        class_qhats = np.array([cluster_qhats[cluster_assignments[k]] for k in range(num_classes)])
+        class_qhats = cluster_qhats[cluster_assignments]
 
         return class_qhats
 
@@ -818,14 +833,15 @@ def compute_exact_coverage_class_specific_params(scores_all, labels, num_classes
     q_as = np.zeros((num_classes,))   
     q_bs = np.zeros((num_classes,)) 
     gammas = np.zeros((num_classes,)) 
+    
+    # Extract conformal scores for true labels if not already done
+    if len(scores_all.shape) == 2:
+        scores_all = scores_all[np.arange(len(labels)), labels]
+    sorted_scores, starts, ends = group_scores_by_label(scores_all, labels, num_classes)
+    
     for k in range(num_classes):
         # Only select data for which k is true class
-        
-        idx = (labels == k)
-        if len(scores_all.shape) == 2:
-            scores = scores_all[idx, k]
-        else:
-            scores = scores_all[idx]
+        scores = sorted_scores[starts[k]:ends[k]]
         
         q_a, q_b, gamma = get_exact_coverage_conformal_params(scores, alpha, default_qhat=default_qhat)
         q_as[k] = q_a
@@ -856,6 +872,17 @@ def construct_exact_coverage_classwise_sets(q_as, q_bs, gammas, scores_all):
 #   Adaptive Prediction Sets (APS)
 #========================================
 
+# Helper function for APS and RAPS scores
+def tensor_from_numpy(arr):
+    '''
+    Same as torch.from_numpy(arr), but without the warning raised for read-only arrays
+    (e.g., softmax scores memory-mapped by load_dataset). This is safe because the
+    returned tensor is only read, never written to
+    '''
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+        return torch.from_numpy(arr)
+
 def get_APS_scores(softmax_scores, labels, randomize=True, seed=0):
     '''
     Compute conformity score defined in Romano et al, 2020
@@ -869,7 +896,7 @@ def get_APS_scores(softmax_scores, labels, randomize=True, seed=0):
         length-n array of APS scores
     '''
     n = len(labels)
-    sorted, pi = torch.from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
+    sorted, pi = tensor_from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
     scores = sorted.cumsum(dim=1).gather(1,pi.argsort(1))[range(n), labels]
     scores = np.array(scores)
     
@@ -893,7 +920,7 @@ def get_APS_scores_all(softmax_scores, randomize=True, seed=0):
         n x num_classes array of APS scores
     '''
     n = softmax_scores.shape[0]
-    sorted, pi = torch.from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
+    sorted, pi = tensor_from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
     scores = sorted.cumsum(dim=1).gather(1,pi.argsort(1))
     scores = np.array(scores)
     
@@ -923,7 +950,7 @@ def get_RAPS_scores(softmax_scores, labels, lmbda=.01, kreg=5, randomize=True, s
     
     '''
     n = len(labels)
-    sorted, pi = torch.from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
+    sorted, pi = tensor_from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
     scores = sorted.cumsum(dim=1).gather(1,pi.argsort(1))[range(n), labels]
     
     # Regularization
@@ -953,7 +980,7 @@ def get_RAPS_scores_all(softmax_scores, lmbda, kreg, randomize=True, seed=0):
         n x num_classes array of APS scores
     '''
     n = softmax_scores.shape[0]
-    sorted, pi = torch.from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
+    sorted, pi = tensor_from_numpy(softmax_scores).sort(dim=1, descending=True) # pi is the indices in the original array
     scores = sorted.cumsum(dim=1).gather(1,pi.argsort(1))
     
     # Regularization (pretend each class is true label)
@@ -1,19 +1,25 @@
-import glob # For getting file names
+import heapq
 import numpy as np
 import os
 import pandas as pd
 import pickle
 import seaborn as sns
+import tempfile
 
 import pdb
 
-from collections import Counter
+from collections.abc import Mapping
+from functools import lru_cache
+from joblib import Parallel, delayed
 from scipy import stats, cluster
 
 from utils.clustering_utils import *
 from utils.conformal_utils import *
 
 
+PICKLE_BUFFER_SIZE = 1 << 20 # Buffer size (in bytes) for reading and writing results files
+
+
 # Used for processing iNaturalist dataset
 def remove_rare_classes(softmax_scores, labels, thresh = 250):
     '''
@@ -28,53 +34,336 @@ def remove_rare_classes(softmax_scores, labels, thresh = 250):
     print(f'Data preprocessing: Keeping {len(non_rare_classes)} of {len(classes)} classes that have >= {thresh} examples')
 
     # Filter labels and re-index
-    remaining_label_idx = np.isin(labels, non_rare_classes)
+    # non_rare_classes is sorted, so membership can be checked by binary search
+    if len(non_rare_classes) == 0:
+        remaining_label_idx = np.zeros(len(labels), dtype=bool)
+    else:
+        pos = np.searchsorted(non_rare_classes, labels).clip(max=len(non_rare_classes)-1)
+        remaining_label_idx = (non_rare_classes[pos] == labels)
     labels = labels[remaining_label_idx]
-    new_idx = 0
-    mapping = {} # old to new
-    for i, label in enumerate(labels):
-        if label not in mapping:
-            mapping[label] = new_idx
-            new_idx += 1
-        labels[i] = mapping[label]
-    
+    # Old label non_rare_classes[i] is mapped to new label i
+    _, labels = np.unique(labels, return_inverse=True)
+
     # Remove rows and columns corresponding to rare classes from scores matrix
-    softmax_scores = softmax_scores[remaining_label_idx,:]
-    new_softmax_scores = np.zeros((len(labels), len(non_rare_classes)))
-    for k in non_rare_classes:
-        new_softmax_scores[:, mapping[k]] = softmax_scores[:,k]
+    new_softmax_scores = softmax_scores[remaining_label_idx][:, non_rare_classes]
     
-    # Renormalize each row to sum to 1 
-    new_softmax_scores = new_softmax_scores / np.expand_dims(np.sum(new_softmax_scores, axis=1), axis=1)
+    # Renormalize each row to sum to 1 (in place, since new_softmax_scores is already a copy)
+    row_sums = new_softmax_scores.sum(axis=1, keepdims=True)
+    np.divide(new_softmax_scores, row_sums, out=new_softmax_scores)
 
     return new_softmax_scores, labels
 
 
 
-def load_dataset(dataset, data_folder='data'):
+# Helper function
+def save_npy_atomically(path, arr):
+    '''
+    Save arr to path via a temporary file in the same folder that is then renamed into place, so that
+    concurrent jobs never load (or memory-map) a partially written or truncated file
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        # mkstemp creates files with mode 0600; give the file the permissions np.save would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+# Helper function for load_dataset
+def get_npy_paths(dataset, data_folder='data'):
+    '''
+    Returns paths of the <dataset name>_softmax.npy and <dataset name>_labels.npy files
+    '''
+    return f'{data_folder}/{dataset}_softmax.npy', f'{data_folder}/{dataset}_labels.npy'
+
+
+# Helper function for load_dataset
+def convert_npz_to_npy(dataset, data_folder='data'):
+    '''
+    One-time conversion of <dataset name>.npz into <dataset name>_softmax.npy and
+    <dataset name>_labels.npy, which can be memory-mapped instead of read in full
+    '''
+    softmax_path, labels_path = get_npy_paths(dataset, data_folder)
+    with np.load(f'{data_folder}/{dataset}.npz') as data:
+        save_npy_atomically(softmax_path, data['softmax'])
+        save_npy_atomically(labels_path, data['labels'])
+    print(f'Converted {data_folder}/{dataset}.npz to .npy files')
+
+
+# Helper function for load_dataset
+def is_converted(dataset, data_folder='data'):
+    '''
+    Returns True if both .npy files exist and are at least as new as <dataset name>.npz (if it exists)
+    '''
+    npz_path = f'{data_folder}/{dataset}.npz'
+    for path in get_npy_paths(dataset, data_folder):
+        if not os.path.exists(path):
+            return False
+        if os.path.exists(npz_path) and os.path.getmtime(path) < os.path.getmtime(npz_path):
+            return False
+    return True
+
+
+def load_dataset(dataset, data_folder='data', use_float32=False):
     '''
     Load softmax scores and labels for a dataset
-    
+
     Input:
         - dataset: string specifying dataset. Options are 'imagenet', 'cifar-100', 'places365', 'inaturalist'
         - data_folder: string specifying folder containing the <dataset name>.npz files
+        - use_float32: If True, cast softmax scores to float32, which halves the memory used by all
+        downstream computations. Results may differ slightly from float64, so this is off by default
+
+    Output: softmax_scores, labels (read-only memory-mapped arrays, except that softmax_scores is an
+    in-memory float32 copy if use_float32 is True and the scores are not already stored as float32)
 
-    Output: softmax_scores, labels
-        
     '''
     assert dataset in ['imagenet', 'cifar-100', 'places365', 'inaturalist']
-    
-    
-    data = np.load(f'{data_folder}/{dataset}.npz')
-    softmax_scores = data['softmax']
-    labels = data['labels']
-    
+
+    # The .npy files are (re)created if missing or older than the .npz file. Files are replaced 
+    # atomically, so jobs that already memory-mapped the old files are unaffected
+    softmax_path, labels_path = get_npy_paths(dataset, data_folder)
+    if not is_converted(dataset, data_folder):
+        convert_npz_to_npy(dataset, data_folder=data_folder)
+
+    # Pages are only read from disk when they are accessed
+    softmax_scores = np.load(softmax_path, mmap_mode='r')
+    labels = np.load(labels_path, mmap_mode='r')
+
+    if use_float32: # Note: this reads the full matrix into memory unless it is already stored as float32
+        softmax_scores = softmax_scores.astype(np.float32, copy=False)
+
     return softmax_scores, labels
 
 
+# Helper function for save_all_results and load_all_results
+def get_arrays_path(save_to):
+    '''
+    Path of the .npz file storing the qhats and preds that accompany the results pickle save_to
+    '''
+    return save_to.replace('_allresults.pkl', '_arrays.npz')
+
+
+def save_all_results(all_results, save_to):
+    '''
+    Save output of run_one_experiment for one seed. The coverage and set size metrics are
+    pickled to save_to (with qhat(s) and preds replaced by None), while the qhat(s) and preds are
+    saved as numeric arrays in get_arrays_path(save_to)
+
+    Inputs:
+        - all_results: dict mapping method to (qhat(s), preds, coverage_metrics, set_size_metrics)
+        - save_to: path to .pkl file ending in '_allresults.pkl'
+    '''
+    metrics = {}
+    arrays = {}
+    for method, (qhat, preds, coverage_metrics, set_size_metrics) in all_results.items():
+        metrics[method] = (None, None, coverage_metrics, set_size_metrics)
+
+        # Exact coverage methods return a dict {'q_a': ..., 'q_b': ..., 'gamma': ...}
+        if isinstance(qhat, Mapping):
+            for key, val in qhat.items():
+                arrays[f'{method}_qhat_{key}'] = val
+        else:
+            arrays[f'{method}_qhat'] = qhat
+
+        # Prediction sets have varying sizes, so store them concatenated along with offsets
+        if preds is not None:
+            arrays[f'{method}_preds'] = np.concatenate(preds) if len(preds) > 0 else np.array([], dtype=int)
+            arrays[f'{method}_preds_offsets'] = np.cumsum([0] + [len(p) for p in preds])
+
+    np.savez(get_arrays_path(save_to), **arrays)
+    with open(save_to,'wb', buffering=PICKLE_BUFFER_SIZE) as f:
+        pickle.dump(metrics, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_all_results(save_to):
+    '''
+    Load results saved by save_all_results(). Returns dict mapping method to
+    (qhat(s), preds, coverage_metrics, set_size_metrics), where preds is None if
+    predictions were not saved
+    '''
+    with open(save_to,'rb', buffering=PICKLE_BUFFER_SIZE) as f:
+        all_results = pickle.load(f)
+
+    arrays_path = get_arrays_path(save_to)
+    if not os.path.exists(arrays_path): # Results pickled in full
+        return all_results
+
+    with np.load(arrays_path) as arrays:
+        for method, (_, _, coverage_metrics, set_size_metrics) in all_results.items():
+            if f'{method}_qhat' in arrays:
+                qhat = arrays[f'{method}_qhat'][()] # [()] unwraps 0-d arrays into scalars
+            else:
+                qhat = {key: arrays[f'{method}_qhat_{key}'][()] for key in ['q_a', 'q_b', 'gamma']}
+
+            preds = None
+            if f'{method}_preds' in arrays:
+                offsets = arrays[f'{method}_preds_offsets']
+                preds = np.split(arrays[f'{method}_preds'], offsets[1:-1])
+
+            all_results[method] = (qhat, preds, coverage_metrics, set_size_metrics)
+
+    return all_results
+
+
+# Helper function for run_one_experiment
+def run_one_seed(seed, scores_all, labels, curr_folder, dataset, score_function, alpha, n_totalcal, methods,
+                 cluster_args, save_preds, calibration_sampling, save_labels, overwrite):
+    '''
+    Split data into calibration and validation sets using seed, run each method, and save
+    results to {curr_folder}/seed={seed}_allresults.pkl. See run_one_experiment() for a
+    description of the inputs.
+    '''
+    print(f'\nseed={seed}')
+    save_to = os.path.join(curr_folder, f'seed={seed}_allresults.pkl')
+    if os.path.exists(save_to):
+        all_results = load_all_results(save_to)
+        print('Loaded existing results file containing results for', list(all_results.keys()))
+        if not save_preds:
+            for m in all_results.keys():
+                all_results[m] = (all_results[m][0], None, all_results[m][2], all_results[m][3])
+    else:
+        all_results = {} # Each value is (qhat(s), preds, coverage_metrics, set_size_metrics)
+
+    if not overwrite and not save_labels and all(method in all_results for method in methods):
+        print('All methods already computed for this seed. Skipping')
+        return
+
+    # Split data
+    if calibration_sampling == 'random':
+        totalcal_scores_all, totalcal_labels, val_scores_all, val_labels = random_split(scores_all, 
+                                                                                        labels, 
+                                                                                        n_totalcal, 
+                                                                                        seed=seed)
+    elif calibration_sampling == 'balanced':
+        num_classes = scores_all.shape[1]
+        totalcal_scores_all, totalcal_labels, val_scores_all, val_labels = split_X_and_y(scores_all, 
+                                                                                        labels, n_totalcal, num_classes, 
+                                                                                        seed=seed, split='balanced')
+    else:
+        raise Exception('Invalid calibration_sampling option')
+
+    # Inspect class imbalance of total calibration set
+    cts = np.bincount(totalcal_labels)
+    cts = cts[cts > 0] # Ignore classes that do not appear
+    print(f'Class counts range from {cts.min()} to {cts.max()}')
+
+    for method in methods:
+        if method in all_results and not overwrite:
+            print(f'Skipping method={method} since results already exist')
+            continue
+        print(f'----- dataset={dataset}, n={n_totalcal},score_function={score_function}, seed={seed}, method={method} ----- ')
+
+        if method == 'standard':
+            # Standard conformal
+            all_results[method] = standard_conformal(totalcal_scores_all, totalcal_labels, 
+                                                     val_scores_all, val_labels, alpha)
+
+        elif method == 'classwise':
+            # Classwise conformal  
+            all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
+                                                       val_scores_all, val_labels, alpha, 
+                                                       num_classes=totalcal_scores_all.shape[1],
+                                                       default_qhat=np.inf, regularize=False)
+
+        elif method == 'classwise_default_standard':
+            # Classwise conformal, but use standard qhat as default value instead of infinity 
+            all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
+                                                       val_scores_all, val_labels, alpha, 
+                                                       num_classes=totalcal_scores_all.shape[1],
+                                                       default_qhat='standard', regularize=False)
+        elif method == 'classwise_default_max':
+            # Classwise conformal, but use largest conformal score in calibration dataset for each y
+            # as default value instead of infinity 
+            all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
+                                                       val_scores_all, val_labels, alpha, 
+                                                       num_classes=totalcal_scores_all.shape[1],
+                                                       default_qhat='max', regularize=False)
+
+        elif method == 'cluster_proportional':
+            # Clustered conformal with proportionally sampled clustering set
+            all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
+                                                        alpha,
+                                                        val_scores_all, val_labels, 
+                                                        split='proportional')
+
+        elif method == 'cluster_doubledip':
+            # Clustered conformal with double dipping for clustering and calibration
+            all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
+                                                       alpha,
+                                                        val_scores_all, val_labels, 
+                                                        split='doubledip')
+
+        elif method == 'cluster_random':
+            # [RECOMMENDED] Clustered conformal with double dipping for clustering and calibration
+            all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
+                                                        alpha,
+                                                        val_scores_all, val_labels, 
+                                                        frac_clustering=cluster_args['frac_clustering'],
+                                                        num_clusters=cluster_args['num_clusters'],
+                                                        split='random')
+        elif method == 'regularized_classwise':
+            # Empirical-Bayes-inspired regularized classwise conformal (shrink class qhats to standard)
+            all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
+                                                       val_scores_all, val_labels, alpha, 
+                                                       num_classes=totalcal_scores_all.shape[1],
+                                                       default_qhat='standard', regularize=True)
+
+        elif method == 'exact_coverage_standard':
+            # Apply randomization to qhat to achieve exact coverage
+            all_results[method] = standard_conformal(totalcal_scores_all, totalcal_labels,
+                                                                    val_scores_all, val_labels, alpha,
+                                                                    exact_coverage=True)
+
+        elif method == 'exact_coverage_classwise':
+            # Apply randomization to qhats to achieve exact coverage
+            all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
+                                                       val_scores_all, val_labels, alpha, 
+                                                       num_classes=totalcal_scores_all.shape[1],
+                                                       default_qhat=np.inf, regularize=False,
+                                                       exact_coverage=True)
+
+
+        elif method == 'exact_coverage_cluster':
+            # Apply randomization to qhats to achieve exact coverage
+            all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
+                                                        alpha,
+                                                        val_scores_all, val_labels, 
+                                                        frac_clustering=cluster_args['frac_clustering'],
+                                                        num_clusters=cluster_args['num_clusters'],
+                                                        split='random',
+                                                        exact_coverage=True)
+
+        else: 
+            raise Exception('Invalid method selected')
+
+        # Optionally remove predictions from saved output as soon as metrics are computed,
+        # so that only one method's prediction sets are held in memory at a time
+        if not save_preds:
+            qhat, _, coverage_metrics, set_size_metrics = all_results[method]
+            all_results[method] = (qhat, None, coverage_metrics, set_size_metrics)
+
+    # Optionally save val labels
+    if save_labels:
+        save_labels_to = os.path.join(curr_folder, f'seed={seed}_labels.npy')
+        np.save(save_labels_to, val_labels)
+        print(f'Saved labels to {save_labels_to}')
+
+    # Save results 
+    save_all_results(all_results, save_to)
+    print(f'Saved results to {save_to}')
+
+
 def run_one_experiment(dataset, save_folder, alpha, n_totalcal, score_function_list, methods, seeds, 
                        cluster_args={'frac_clustering':'auto', 'num_clusters':'auto'},
-                       save_preds=False, calibration_sampling='random', save_labels=False):
+                       save_preds=False, calibration_sampling='random', save_labels=False,
+                       data_folder='data', overwrite=False, n_jobs=1, use_float32=False):
     '''
     Run experiment and save results
     
@@ -89,10 +378,16 @@ def run_one_experiment(dataset, save_folder, alpha, n_totalcal, score_function_l
         - calibration_sampling: Method for sampling calibration dataset. Options are 
         'random' or 'balanced'
         - save_labels: If True, save the labels for each random seed in {save_folder}seed={seed}_labels.npy
+        - data_folder: Folder containing the dataset files. APS and RAPS scores are cached in 
+        {data_folder}/cache/
+        - overwrite: If False, methods that already have results saved for a seed are not rerun
+        - n_jobs: Number of seeds to run in parallel (passed to joblib.Parallel; -1 uses all cores).
+        Note that each job holds its own copy of the calibration and validation sets in memory
+        - use_float32: If True, compute conformal scores from float32 softmax scores (see load_dataset)
     '''
     np.random.seed(0)
     
-    softmax_scores, labels = load_dataset(dataset)
+    softmax_scores, labels = load_dataset(dataset, data_folder=data_folder, use_float32=use_float32)
     
     for score_function in score_function_list:
         curr_folder = os.path.join(save_folder, f'{dataset}/{calibration_sampling}_calset/n_totalcal={n_totalcal}/score={score_function}')
@@ -100,164 +395,85 @@ def run_one_experiment(dataset, save_folder, alpha, n_totalcal, score_function_l
 
         print(f'====== score_function={score_function} ======')
 
-        print('Computing conformal score...')
-        if score_function == 'softmax':
-            scores_all = 1 - softmax_scores
-        elif score_function == 'APS':
-            scores_all = get_APS_scores_all(softmax_scores, randomize=True)
-        elif score_function == 'RAPS': 
-            # RAPS hyperparameters (currently using ImageNet defaults)
-            lmbda = .01 
-            kreg = 5
-
-            scores_all = get_RAPS_scores_all(softmax_scores, lmbda, kreg, randomize=True)
+        # RAPS hyperparameters (currently using ImageNet defaults)
+        lmbda = .01 
+        kreg = 5
+
+        # APS and RAPS scores require sorting every row, so they are cached to disk.
+        # (Both use a fixed seed for randomization, so the cached scores are reproducible.) 
+        # The file name includes every setting the scores depend on, and the cache is ignored 
+        # if it is older than the softmax scores it was computed from
+        cache_name = f'{dataset}_{score_function}'
+        if score_function == 'RAPS':
+            cache_name += f'_lmbda={lmbda}_kreg={kreg}'
+        if use_float32:
+            cache_name += '_float32'
+        cache_path = os.path.join(data_folder, 'cache', f'{cache_name}.npy')
+        softmax_path, _ = get_npy_paths(dataset, data_folder)
+        if (score_function in ['APS', 'RAPS'] and os.path.exists(cache_path) 
+            and os.path.getmtime(cache_path) >= os.path.getmtime(softmax_path)):
+            print(f'Loading cached conformal score from {cache_path}...')
+            scores_all = np.load(cache_path, mmap_mode='r')
         else:
-            raise Exception('Undefined score function')
-
-        for seed in seeds:
-            print(f'\nseed={seed}')
-            save_to = os.path.join(curr_folder, f'seed={seed}_allresults.pkl')
-            if os.path.exists(save_to):
-                with open(save_to,'rb') as f:
-                    all_results = pickle.load(f)
-                    print('Loaded existing results file containing results for', list(all_results.keys()))
-            else:
-                all_results = {} # Each value is (qhat(s), preds, coverage_metrics, set_size_metrics)
-
-            # Split data
-            if calibration_sampling == 'random':
-                totalcal_scores_all, totalcal_labels, val_scores_all, val_labels = random_split(scores_all, 
-                                                                                                labels, 
-                                                                                                n_totalcal, 
-                                                                                                seed=seed)
-            elif calibration_sampling == 'balanced':
-                num_classes = scores_all.shape[1]
-                totalcal_scores_all, totalcal_labels, val_scores_all, val_labels = split_X_and_y(scores_all, 
-                                                                                                labels, n_totalcal, num_classes, 
-                                                                                                seed=seed, split='balanced')
+            print('Computing conformal score...')
+            if score_function == 'softmax':
+                scores_all = 1 - softmax_scores
+            elif score_function == 'APS':
+                scores_all = get_APS_scores_all(softmax_scores, randomize=True)
+            elif score_function == 'RAPS': 
+                scores_all = get_RAPS_scores_all(softmax_scores, lmbda, kreg, randomize=True)
             else:
-                raise Exception('Invalid calibration_sampling option')
-          
-            # Inspect class imbalance of total calibration set
-            cts = Counter(totalcal_labels).values()
-            print(f'Class counts range from {min(cts)} to {max(cts)}')
-
-            for method in methods:
-                print(f'----- dataset={dataset}, n={n_totalcal},score_function={score_function}, seed={seed}, method={method} ----- ')
-
-                if method == 'standard':
-                    # Standard conformal
-                    all_results[method] = standard_conformal(totalcal_scores_all, totalcal_labels, 
-                                                             val_scores_all, val_labels, alpha)
-
-                elif method == 'classwise':
-                    # Classwise conformal  
-                    all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
-                                                               val_scores_all, val_labels, alpha, 
-                                                               num_classes=totalcal_scores_all.shape[1],
-                                                               default_qhat=np.inf, regularize=False)
-
-                elif method == 'classwise_default_standard':
-                    # Classwise conformal, but use standard qhat as default value instead of infinity 
-                    all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
-                                                               val_scores_all, val_labels, alpha, 
-                                                               num_classes=totalcal_scores_all.shape[1],
-                                                               default_qhat='standard', regularize=False)
-                elif method == 'classwise_default_max':
-                    # Classwise conformal, but use largest conformal score in calibration dataset for each y
-                    # as default value instead of infinity 
-                    all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
-                                                               val_scores_all, val_labels, alpha, 
-                                                               num_classes=totalcal_scores_all.shape[1],
-                                                               default_qhat='max', regularize=False)
-                    
-                elif method == 'cluster_proportional':
-                    # Clustered conformal with proportionally sampled clustering set
-                    all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
-                                                                alpha,
-                                                                val_scores_all, val_labels, 
-                                                                split='proportional')
-                
-                elif method == 'cluster_doubledip':
-                    # Clustered conformal with double dipping for clustering and calibration
-                    all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
-                                                               alpha,
-                                                                val_scores_all, val_labels, 
-                                                                split='doubledip')
-
-                elif method == 'cluster_random':
-                    # [RECOMMENDED] Clustered conformal with double dipping for clustering and calibration
-                    all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
-                                                                alpha,
-                                                                val_scores_all, val_labels, 
-                                                                frac_clustering=cluster_args['frac_clustering'],
-                                                                num_clusters=cluster_args['num_clusters'],
-                                                                split='random')
-                elif method == 'regularized_classwise':
-                    # Empirical-Bayes-inspired regularized classwise conformal (shrink class qhats to standard)
-                    all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
-                                                               val_scores_all, val_labels, alpha, 
-                                                               num_classes=totalcal_scores_all.shape[1],
-                                                               default_qhat='standard', regularize=True)
-                
-                elif method == 'exact_coverage_standard':
-                    # Apply randomization to qhat to achieve exact coverage
-                    all_results[method] = standard_conformal(totalcal_scores_all, totalcal_labels,
-                                                                            val_scores_all, val_labels, alpha,
-                                                                            exact_coverage=True)
-                    
-                elif method == 'exact_coverage_classwise':
-                    # Apply randomization to qhats to achieve exact coverage
-                    all_results[method] = classwise_conformal(totalcal_scores_all, totalcal_labels, 
-                                                               val_scores_all, val_labels, alpha, 
-                                                               num_classes=totalcal_scores_all.shape[1],
-                                                               default_qhat=np.inf, regularize=False,
-                                                               exact_coverage=True)
-
-
-                elif method == 'exact_coverage_cluster':
-                    # Apply randomization to qhats to achieve exact coverage
-                    all_results[method] = clustered_conformal(totalcal_scores_all, totalcal_labels,
-                                                                alpha,
-                                                                val_scores_all, val_labels, 
-                                                                frac_clustering=cluster_args['frac_clustering'],
-                                                                num_clusters=cluster_args['num_clusters'],
-                                                                split='random',
-                                                                exact_coverage=True)
-
-                else: 
-                    raise Exception('Invalid method selected')
-            
-            # Optionally remove predictions from saved output to reduce memory usage
-            if not save_preds:
-                for m in all_results.keys():
-                    all_results[m] = (all_results[m][0], None, all_results[m][2], all_results[m][3])
-                    
-            # Optionally save val labels
-            if save_labels:
-                save_labels_to = os.path.join(curr_folder, f'seed={seed}_labels.npy')
-                np.save(save_labels_to, val_labels)
-                print(f'Saved labels to {save_labels_to}')
-                
-            # Save results 
-            with open(save_to,'wb') as f:
-                pickle.dump(all_results, f)
-                print(f'Saved results to {save_to}')
+                raise Exception('Undefined score function')
+
+            if score_function in ['APS', 'RAPS']:
+                # Written atomically, since concurrent jobs for the same dataset may be reading the cache
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                save_npy_atomically(cache_path, np.asarray(scores_all))
+                print(f'Cached conformal score to {cache_path}')
+
+        # Materialize scores as a C-contiguous numpy array once (RAPS returns a torch tensor), so that
+        # every per-seed split gathers contiguous rows. Memory-mapped scores that are already
+        # contiguous are not copied
+        scores_all = np.ascontiguousarray(scores_all, dtype=np.float32 if use_float32 else None)
+
+        # Seeds are independent (each split is reseeded), so they can be run in parallel.
+        # run_one_seed saves its results to disk and returns nothing, so no seed's results are
+        # kept in memory (or sent back from workers) after it finishes
+        Parallel(n_jobs=n_jobs)(delayed(run_one_seed)(seed, scores_all, labels, curr_folder, 
+                                                      dataset, score_function, alpha, n_totalcal, methods,
+                                                      cluster_args, save_preds, calibration_sampling,
+                                                      save_labels, overwrite)
+                                for seed in seeds)
+
+# Helper function
+def get_results_file_names(folder):
+    '''
+    Returns (unsorted) list of paths to the .pkl results files in folder. Same files as
+    glob.glob(os.path.join(folder, '*.pkl')), but listed with a single os.scandir call
+    '''
+    if not os.path.isdir(folder):
+        return []
+    with os.scandir(folder) as it:
+        return [entry.path for entry in it 
+                if entry.name.endswith('.pkl') and not entry.name.startswith('.')]
+
+# Metrics aggregated by average_results_across_seeds. Each entry is (metric name, index of the 
+# metrics dict within a method's results tuple, key in that dict, scale applied in the output table)
+SEED_METRICS = [('class_cov_gap', 2, 'mean_class_cov_gap', 100),
+                ('max_class_cov_gap', 2, 'max_gap', 100),
+                ('avg_set_size', 3, 'mean', 1),
+                ('marginal_cov', 2, 'marginal_cov', 1),
+                ('very_undercovered', 2, 'very_undercovered', 1),
+                ('undercov_gap', 2, 'undercov_gap', 100),
+                ('overcov_gap', 2, 'overcov_gap', 100)] # Could also retrieve other metrics
 
 # Helper function                
-def initialize_metrics_dict(methods):
-    
-    metrics = {}
-    for method in methods:
-        metrics[method] = {'class_cov_gap': [],
-                           'max_class_cov_gap': [],
-                           'avg_set_size': [],
-                           'marginal_cov': [],
-                           'very_undercovered': [],
-                           'undercov_gap': [],
-                           'overcov_gap': []} # Could also retrieve other metrics
-        
-    return metrics
+def initialize_metrics_array(methods, num_seeds):
+    '''
+    Returns (num_methods, num_metrics, num_seeds) array of NaNs, where entry [j,m,i] will 
+    store metric SEED_METRICS[m] for method j and seed i
+    '''
+    return np.full((len(methods), len(SEED_METRICS), num_seeds), np.nan)
 
 # Original version, without undercov_gap and overcov_gap
 # def average_results_across_seeds(folder, print_results=True, display_table=True, show_seed_ct=False, 
@@ -355,112 +571,86 @@ def average_results_across_seeds(folder, print_results=True, display_table=True,
     '''
 
     
-    file_names = sorted(glob.glob(os.path.join(folder, '*.pkl')))
+    file_names = get_results_file_names(folder)
     num_seeds = len(file_names)
     if show_seed_ct:
         print('Number of seeds found:', num_seeds)
     if max_seeds < np.inf and num_seeds > max_seeds:
         print(f'Only using {max_seeds} seeds')
-        file_names = file_names[:max_seeds]
+        file_names = heapq.nsmallest(int(max_seeds), file_names) # Avoids sorting all file names
+    else:
+        file_names = sorted(file_names)
     
-    metrics = initialize_metrics_dict(methods)
+    metrics = initialize_metrics_array(methods, len(file_names))
     
-    for pth in file_names:
-        with open(pth, 'rb') as f:
+    for i, pth in enumerate(file_names):
+        with open(pth, 'rb', buffering=PICKLE_BUFFER_SIZE) as f:
             results = pickle.load(f)
                         
-        for method in methods:
-            try:
-                metrics[method]['class_cov_gap'].append(results[method][2]['mean_class_cov_gap'])
-                metrics[method]['avg_set_size'].append(results[method][3]['mean'])
-                metrics[method]['max_class_cov_gap'].append(results[method][2]['max_gap'])
-                metrics[method]['marginal_cov'].append(results[method][2]['marginal_cov'])
-                metrics[method]['very_undercovered'].append(results[method][2]['very_undercovered'])
-                metrics[method]['undercov_gap'].append(results[method][2]['undercov_gap']) # ADDED
-                metrics[method]['overcov_gap'].append(results[method][2]['overcov_gap']) # ADDED
-            except:
+        for j, method in enumerate(methods):
+            if method not in results:
                 print(f'Missing {method} in {pth}')
+                continue
+            # Metrics missing from older results files are left as NaN
+            metrics[j,:,i] = [results[method][idx].get(key, np.nan) for _, idx, key, _ in SEED_METRICS]
             
-#     print(folder)
-#     for method in methods:
-#         print(method, metrics[method]['class_cov_gap'])
-            
-    cov_means = []
-    cov_ses = []
-    set_size_means = []
-    set_size_ses = []
-    max_cov_gap_means = []
-    max_cov_gap_ses = []
-    marginal_cov_means = []
-    marginal_cov_ses = []
-    very_undercovered_means = []
-    very_undercovered_ses = []
-    undercov_means = []
-    undercov_ses = []
-    overcov_means = []
-    overcov_ses = []
+    # Missing results are left as NaN and ignored when averaging
+    n = num_seeds
+    means = np.nanmean(metrics, axis=2)
+    ses = np.nanstd(metrics, axis=2)/np.sqrt(n)
     
     if print_results:
         print('Avg class coverage gap for each random seed:')
-    for method in methods:
-        n = num_seeds
-        if print_results:
-            print(f'  {method}:', np.array(metrics[method]['class_cov_gap'])*100)
-        cov_means.append(np.mean(metrics[method]['class_cov_gap']))
-        cov_ses.append(np.std(metrics[method]['class_cov_gap'])/np.sqrt(n))
-        
-        set_size_means.append(np.mean(metrics[method]['avg_set_size']))
-        set_size_ses.append(np.std(metrics[method]['avg_set_size'])/np.sqrt(n))
-        
-        max_cov_gap_means.append(np.mean(metrics[method]['max_class_cov_gap']))
-        max_cov_gap_ses.append(np.std(metrics[method]['max_class_cov_gap'])/np.sqrt(n))
-        
-        marginal_cov_means.append(np.mean(metrics[method]['marginal_cov']))
-        marginal_cov_ses.append(np.std(metrics[method]['marginal_cov'])/np.sqrt(n))
-        
-        very_undercovered_means.append(np.mean(metrics[method]['very_undercovered']))
-        very_undercovered_ses.append(np.std(metrics[method]['very_undercovered'])/np.sqrt(n))
-        
-        undercov_means.append(np.mean(metrics[method]['undercov_gap']))
-        undercov_ses.append(np.std(metrics[method]['undercov_gap'])/np.sqrt(n))
+        for j, method in enumerate(methods):
+            print(f'  {method}:', metrics[j,0,:]*100)
         
-        overcov_means.append(np.mean(metrics[method]['overcov_gap']))
-        overcov_ses.append(np.std(metrics[method]['overcov_gap'])/np.sqrt(n))
-        
-    df = pd.DataFrame({'method': methods,
-                      'class_cov_gap_mean': np.array(cov_means)*100,
-                      'class_cov_gap_se': np.array(cov_ses)*100,
-                      'max_class_cov_gap_mean': np.array(max_cov_gap_means)*100,
-                      'max_class_cov_gap_se': np.array(max_cov_gap_ses)*100,
-                      'avg_set_size_mean': set_size_means,
-                      'avg_set_size_se': set_size_ses,
-                      'marginal_cov_mean': marginal_cov_means,
-                      'marginal_cov_se': marginal_cov_ses,
-                      'very_undercovered_mean': very_undercovered_means,
-                      'very_undercovered_se': very_undercovered_ses,
-                      'undercov_gap_mean': np.array(undercov_means)*100,
-                      'undercov_gap_se': np.array(undercov_ses)*100,
-                      'overcov_gap_mean': np.array(overcov_means)*100,
-                      'overcov_gap_se': np.array(overcov_ses)*100})
+    table = {'method': methods}
+    for m, (metric, _, _, scale) in enumerate(SEED_METRICS):
+        table[f'{metric}_mean'] = means[:,m]*scale
+        table[f'{metric}_se'] = ses[:,m]*scale
+    df = pd.DataFrame(table)
     
     if display_table:
         display(df) # For Jupyter notebooks
         
     return df
 
-# Helper function for get_metric_df
-def initialize_dict(metrics, methods, suffixes=['mean', 'se']):
-    d = {}
-    for suffix in suffixes: 
-        for metric in metrics:
-            d[f'{metric}_{suffix}'] = {}
+# Helper function for cached_average_results_across_seeds
+def get_results_version(folder):
+    '''
+    Returns a hashable summary (file names and modification times) of the .pkl results files in folder, 
+    which changes whenever results files are added, removed, or rewritten
+    '''
+    return tuple(sorted((os.path.basename(pth), os.stat(pth).st_mtime_ns) 
+                        for pth in get_results_file_names(folder)))
 
-            for method in methods:
+# Helper function for cached_average_results_across_seeds
+@lru_cache(maxsize=128)
+def memoized_average_results_across_seeds(folder, methods, max_seeds, show_seed_ct, results_version):
+    return average_results_across_seeds(folder, print_results=False, display_table=False, 
+                                        show_seed_ct=show_seed_ct, methods=methods, max_seeds=max_seeds)
 
-                d[f'{metric}_{suffix}'][method] = []
-            
-            
-    return d
+# Helper function for get_metric_df
+def cached_average_results_across_seeds(folder, methods, max_seeds=np.inf, show_seed_ct=False):
+    '''
+    Memoized version of average_results_across_seeds (without printing or displaying results), 
+    so that notebooks that query the same folder for several metrics only load the results files once.
+    The cache is keyed on the absolute folder path and on get_results_version(folder), so adding or 
+    rewriting results files invalidates it. Messages such as the seed count or missing methods are 
+    only printed when the results are actually loaded. 
+    
+    Note: The returned DataFrame is shared between calls and should not be modified
+    '''
+    return memoized_average_results_across_seeds(os.path.abspath(folder), tuple(methods), max_seeds, 
+                                                 show_seed_ct, get_results_version(folder))
+
+# Helper function for get_metric_df
+def initialize_dict(metrics, methods, suffixes=['mean', 'se']):
+    '''
+    Returns dict mapping f'{metric}_{suffix}' to a dict mapping each method to an empty list
+    '''
+    return {f'{metric}_{suffix}': {method: [] for method in methods}
+            for suffix in suffixes for metric in metrics}
 
 def get_metric_df(dataset, cal_sampling, metric, 
                   score_function,
@@ -468,9 +658,13 @@ def get_metric_df(dataset, cal_sampling, metric,
                   n_list = [10, 20, 30, 40, 50, 75, 100, 150],
                   show_seed_ct=False,
                   print_folder=True,
-                  save_folder='../.cache/paper/varying_n'): # May have to update this path
+                  save_folder='../.cache/paper/varying_n', # May have to update this path
+                  use_cache=False):
     '''
     Similar to average_results_across_seeds
+    
+    If use_cache is True, the averaged results for each folder are memoized across calls until
+    the folder's results files change (see cached_average_results_across_seeds)
     '''
     
     aggregated_results = initialize_dict([metric], method_list)
@@ -481,9 +675,13 @@ def get_metric_df(dataset, cal_sampling, metric,
         if print_folder:
             print(curr_folder)
 
-        df = average_results_across_seeds(curr_folder, print_results=False, 
-                                          display_table=False, methods=method_list, max_seeds=10,
-                                          show_seed_ct=show_seed_ct)
+        if use_cache:
+            df = cached_average_results_across_seeds(curr_folder, method_list, max_seeds=10,
+                                                     show_seed_ct=show_seed_ct)
+        else:
+            df = average_results_across_seeds(curr_folder, print_results=False, 
+                                              display_table=False, methods=method_list, max_seeds=10,
+                                              show_seed_ct=show_seed_ct)
 
         for method in method_list:
 
@@ -521,7 +719,7 @@ def plot_class_coverage_histogram(folder, desired_cov=None, vmin=.6, vmax=1, nbi
     
     bin_edges = np.linspace(vmin,vmax,nbins+1)
     
-    file_names = sorted(glob.glob(os.path.join(folder, '*.pkl')))
+    file_names = sorted(get_results_file_names(folder))
     num_seeds = len(file_names)
     print('Number of seeds found:', num_seeds)
     
@@ -531,13 +729,18 @@ def plot_class_coverage_histogram(folder, desired_cov=None, vmin=.6, vmax=1, nbi
         cts_dict[method] = np.zeros((num_seeds, nbins))
         
     for i, pth in enumerate(file_names):
-        with open(pth, 'rb') as f:
+        with open(pth, 'rb', buffering=PICKLE_BUFFER_SIZE) as f:
             results = pickle.load(f)
             
         for method in methods:
             
-            cts, _ = np.histogram(results[method][2]['raw_class_coverages'], bins=bin_edges)
-            cts_dict[method][i,:] = cts
+            # Equivalent to np.histogram(class_covs, bins=bin_edges), but skips its input checks.
+            # Bins are [a,b) except for the last, which is [a,b]. Values outside [vmin, vmax] are dropped
+            class_covs = np.asarray(results[method][2]['raw_class_coverages'])
+            idx = np.searchsorted(bin_edges, class_covs, side='right') - 1
+            idx[class_covs == bin_edges[-1]] = nbins - 1
+            idx = idx[(idx >= 0) & (idx < nbins)]
+            cts_dict[method][i,:] = np.bincount(idx, minlength=nbins)
     
     for method in methods:
         bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2